@@ -3,30 +3,139 @@ import json
 import os
 import re
 import time
+import itertools
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+# matches any character that is neither a word character nor whitespace, i.e. the punctuation stripped from each token
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+# postings are stored in the postings file as unsigned 32-bit integers, so every docID must fit in that range
+MAX_DOC_ID = 2 ** 32 - 1
+# number of characters read from the corpus file at a time
+CORPUS_CHUNK_SIZE = 1 << 20
+# matches the (possibly empty) run of whitespace between the JSON values in the corpus file
+WHITESPACE_RE = re.compile(r'\s*')
+# number of documents indexed by each worker process at a time
+SHARD_SIZE = 5000
+# ProcessPoolExecutor can't use more than 61 worker processes on Windows
+MAX_WINDOWS_WORKERS = 61
+# number of lines joined into a single write call when writing the index files
+WRITE_BATCH_SIZE = 10000
 
-def generateIndex(corpus):
-    # TODO: add functionality for document index (format: {docID: text from all zones}) (sorted by docID)
+
+def readCorpusChunk(corpusFile, buffer, pos):
     """
-    This function takes the corpus as a collection of JSON objects, generates a list of tokens from each zone, and creates
-    an inverted index and a document index from the tokens.
+    This function reads the next chunk of the corpus file and appends it to the unconsumed part of the buffer. At least as much as is
+    already buffered is read, so a document spanning many chunks is only re-parsed a few times.
 
     Parameters:
-        corpus (list): a list of JSON objects representing the corpus, where each object is separated into it's doc_id and zones
-    
+        corpusFile (file): the opened corpus file
+        buffer (str): the text read from the corpus file so far
+        pos (int): the position of the first unconsumed character in the buffer
+
     Returns:
-        indexes (list): 2 dictionaries for the inverted index and the document index
+        buffer (str): the unconsumed part of the buffer followed by the new chunk
+        eof (bool): whether the end of the corpus file was reached
     """
 
-    print("generating index dictionaries...")
-    docIDs = []
+    chunk = corpusFile.read(max(CORPUS_CHUNK_SIZE, len(buffer) - pos))
+    return [buffer[pos:] + chunk, chunk == ""]
+
+
+def iterCorpus(corpusFile):
+    """
+    This function reads the corpus file in chunks and yields the documents in the corpus one at a time, so the whole corpus is
+    never held in memory as JSON objects at once.
+
+    Parameters:
+        corpusFile (file): the opened corpus file, which must contain a JSON array of documents
+
+    Yields:
+        doc (dict): the next document in the corpus
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    # what the next non-whitespace character is expected to start: the opening bracket, the first document or the closing bracket,
+    # a document following a comma, a comma/closing bracket following a document, or nothing after the closing bracket
+    expecting = "["
+
+    while True:
+        # skip any whitespace and read more of the file if the end of the buffer was reached
+        pos = WHITESPACE_RE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                # the corpus file may only end after the closing bracket
+                if expecting == "end":
+                    return
+                print("Error: the corpus file ended before the end of the JSON array")
+                sys.exit()
+            [buffer, eof] = readCorpusChunk(corpusFile, buffer, pos)
+            pos = 0
+            continue
+
+        char = buffer[pos]
+        if expecting == "[":
+            if char != "[":
+                print("Error: the corpus must be a JSON array of documents")
+                sys.exit()
+            pos += 1
+            expecting = "first"
+        elif expecting == "end":
+            # only whitespace may follow the closing bracket
+            print("Error: could not parse the corpus file")
+            sys.exit()
+        elif char == "]" and expecting != "doc":
+            pos += 1
+            expecting = "end"
+        elif expecting == ",":
+            if char != ",":
+                print("Error: could not parse the corpus file")
+                sys.exit()
+            pos += 1
+            expecting = "doc"
+        else:
+            # try to decode the next document; if it is cut off by the end of the buffer, read more of the file and try again
+            try:
+                doc, end = decoder.raw_decode(buffer, pos)
+                complete = end < len(buffer) or eof
+            except json.JSONDecodeError:
+                if eof:
+                    print("Error: could not parse the corpus file")
+                    sys.exit()
+                complete = False
+            if not complete:
+                [buffer, eof] = readCorpusChunk(corpusFile, buffer, pos)
+                pos = 0
+                continue
+            pos = end
+            expecting = ","
+            yield doc
+
+
+def indexShard(docs):
+    """
+    This function takes a shard of the corpus as a list of JSON objects, generates a list of tokens from each zone, and creates
+    an inverted index and a document index for the shard from the tokens. It is run in a worker process for each shard.
+
+    Parameters:
+        docs (list): a list of JSON objects from the corpus, where each object is separated into it's doc_id and zones
+
+    Returns:
+        indexes (list): 2 unsorted dictionaries for the shard's inverted index and document index
+    """
+
+    docIDs = set()
     index = {}
     docIndex = {}
 
-    # iterate through each document in the corpus
-    for doc in corpus:
+    # iterate through each document in the shard
+    for doc in docs:
         docId = None
-        docString = ""
+        docTokens = []
 
         # check if the document contains less than 2 zones (incl. the doc_id zone) and if so, print an error message and exit the program
         if len(doc.keys()) <= 1:
@@ -46,47 +155,184 @@ def generateIndex(corpus):
                 if docId in docIDs:
                     print("Error: duplicate docIDs found")
                     sys.exit()
-                docIDs.append(docId)
+                docIDs.add(docId)
                 continue
             
-            # iterate through each word in the zone, tokenize it, and add it to the index
-            for token in doc[key].split():
-                token = re.sub(r'[^\w\s]', '', token).lower()
-                if token != "":
-                    # append the token to the docString
-                    docString += token + " "
-                    # if the token already exists in the index, add the doc_id to the postings list if it is not already there
-                    if token in index:
-                        if docId not in index[token]["postings"]:
-                            index[token]["postings"].append(docId)
-                            index[token]["postings"].sort()
-                            index[token]["DF"] += 1
-                    # if the token does not exist in the index, add it to the index along with it's frequency and postings list
-                    else:
-                        index[token] = {"DF": 1, "postings": [docId]}
+            # tokenize the whole zone at once by stripping punctuation, lowercasing, and splitting on whitespace,
+            # then append the tokens to the list of tokens in the document
+            docTokens += PUNCTUATION_RE.sub("", doc[key]).lower().split()
         
-        # check if docID was found and add the docString to the docIndex
+        # check if docID was found and add the document length and the space-separated document tokens to the docIndex
         if docId == None:
             print("Error: no docID found")
             sys.exit()
-        docIndex[docId] = docString
-            
-    # sort the index alphabetically and return the sorted index
-    index = dict(sorted(index.items()))
-    docIndex = dict(sorted(docIndex.items()))
+        docIndex[docId] = {"length": len(docTokens), "text": " ".join(docTokens)}
+
+        # add the doc_id to the postings list of each distinct token in the document, so each (token, doc_id) pair is only
+        # added once and the postings lists never need to be checked for duplicates
+        for token in set(docTokens):
+            # if the token already exists in the index, add the doc_id to the postings list and update the frequency
+            if token in index:
+                index[token]["postings"].append(docId)
+                index[token]["DF"] += 1
+            # if the token does not exist in the index, add it to the index along with it's frequency and postings list
+            else:
+                index[token] = {"DF": 1, "postings": [docId]}
+
     return [index, docIndex]
 
 
-def generateIndexFiles(indexFileLoc, indexes):
+def mergeShard(index, docIndex, shardIndexes):
     """
-    This function creates an index folder and populates it with index files for each zone
+    This function merges the inverted index and document index of a shard into the inverted index and document index of the corpus
+
+    Parameters:
+        index (dict): the inverted index of the corpus, which is updated in place
+        docIndex (dict): the document index of the corpus, which is updated in place
+        shardIndexes (list): the inverted index and the document index of the shard
+    """
+
+    [shardIndex, shardDocIndex] = shardIndexes
+
+    # check if any of the shard's docIDs were already found in another shard
+    for docId in shardDocIndex:
+        if docId in docIndex:
+            print("Error: duplicate docIDs found")
+            sys.exit()
+    docIndex.update(shardDocIndex)
+
+    # docIDs are unique across shards, so the shard's postings lists can be appended without checking for duplicates
+    for token, entry in shardIndex.items():
+        if token in index:
+            index[token]["postings"] += entry["postings"]
+            index[token]["DF"] += entry["DF"]
+        else:
+            index[token] = entry
+
+
+def getNumWorkers():
+    """
+    This function gets the number of worker processes to index the shards with, which is the number of CPUs this process is allowed
+    to run on (capped at the number of worker processes Windows supports)
+
+    Returns:
+        numWorkers (int): the number of worker processes
+    """
+
+    # the CPU affinity of the process is only available on some platforms, otherwise fall back to the number of CPUs on the machine
+    try:
+        numWorkers = len(os.sched_getaffinity(0))
+    except AttributeError:
+        numWorkers = os.cpu_count() or 1
+    if sys.platform == "win32":
+        numWorkers = min(numWorkers, MAX_WINDOWS_WORKERS)
+    return numWorkers
+
+
+def iterShards(corpus):
+    """
+    This function splits the corpus into shards of up to SHARD_SIZE documents
+
+    Parameters:
+        corpus (iterable): the JSON objects representing the corpus
+
+    Yields:
+        shard (list): the next shard of JSON objects
+    """
+
+    shard = []
+    for doc in corpus:
+        shard.append(doc)
+        if len(shard) == SHARD_SIZE:
+            yield shard
+            shard = []
+    if len(shard) > 0:
+        yield shard
+
+
+def generateIndex(corpus):
+    # TODO: add functionality for document index (format: {docID: text from all zones}) (sorted by docID)
+    """
+    This function takes the corpus as a collection of JSON objects, generates a list of tokens from each zone, and creates
+    an inverted index and a document index from the tokens. The corpus is split into shards which are indexed in parallel
+    worker processes and then merged, unless the corpus fits in a single shard or only one CPU is available.
+
+    Parameters:
+        corpus (iterable): the JSON objects representing the corpus, where each object is separated into it's doc_id and zones
+    
+    Returns:
+        indexes (list): 2 unsorted dictionaries for the inverted index and the document index
+    """
+
+    print("generating index dictionaries...")
+    index = {}
+    docIndex = {}
+
+    shards = iterShards(corpus)
+    firstShard = next(shards, [])
+    secondShard = next(shards, None)
+    numWorkers = getNumWorkers()
+
+    if secondShard == None or numWorkers == 1:
+        # index the shards one at a time in this process
+        mergeShard(index, docIndex, indexShard(firstShard))
+        if secondShard != None:
+            mergeShard(index, docIndex, indexShard(secondShard))
+            for shard in shards:
+                mergeShard(index, docIndex, indexShard(shard))
+    else:
+        # index the shards in worker processes, only reading a few shards ahead of the merged results so the corpus is never
+        # held in memory at once
+        with ProcessPoolExecutor(numWorkers) as executor:
+            pending = deque()
+            for shard in itertools.chain([firstShard, secondShard], shards):
+                pending.append(executor.submit(indexShard, shard))
+                if len(pending) >= 2 * numWorkers:
+                    mergeShard(index, docIndex, pending.popleft().result())
+            while len(pending) > 0:
+                mergeShard(index, docIndex, pending.popleft().result())
+
+    # the indexes are left unsorted since the index files are written in sorted order
+    return [index, docIndex]
+
+
+def writeLines(file, lines):
+    """
+    This function writes lines to a file in batches of WRITE_BATCH_SIZE lines, joining each batch into a single write call
+
+    Parameters:
+        file (file): the opened file to write to
+        lines (iterable): the lines to write, each ending in a newline
+    """
+
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == WRITE_BATCH_SIZE:
+            file.write("".join(batch))
+            batch.clear()
+    file.write("".join(batch))
+
+
+def generateIndexFiles(indexFileLoc, indexes, legacyTsv=False):
+    """
+    This function creates an index folder and populates it with index files for each zone.
+    The postings lists are written to a binary postings file as packed unsigned 32-bit little-endian docIDs in the same order as
+    the terms in the index file, unless the legacy format (with the postings lists written into the index file and no document
+    lengths in the document index file, as read by older versions of the query program) is requested.
 
     Parameters:
         indexFileLoc (str): the path where the user wants the index folder to be created
         indexes (list): dictionaries containing the generated inverted index and the document index
+        legacyTsv (bool): whether to write the index files in the legacy format read by older versions of the query program
     """
 
     print("generating index files...")
+    # check that every docID can be stored in the postings file before creating anything
+    if not legacyTsv and len(indexes[1]) > 0 and (min(indexes[1]) < 0 or max(indexes[1]) > MAX_DOC_ID):
+        print("Error: docIDs must be between 0 and {} (use --legacy-tsv for other docIDs)".format(MAX_DOC_ID))
+        return
+
     # create the index folder
     indexFileLoc = indexFileLoc + "\\index"
     try:
@@ -107,27 +353,59 @@ def generateIndexFiles(indexFileLoc, indexes):
     except FileExistsError:
         print("Error: could not create the index files")
         return
+    # create the postings file
+    if not legacyTsv:
+        try:
+            postingsFile = open("{}\\postings.bin".format(indexFileLoc), "wb")
+        except FileExistsError:
+            print("Error: could not create the index files")
+            return
 
-    # write the document index to the file
-    for doc in indexes[1]:
-        docIndexFile.write("{}\t{}\n".format(doc, indexes[1][doc]))
+    [index, docIndex] = indexes
+    tokens = sorted(index)
+
+    if legacyTsv:
+        # write the document index to the file in the legacy format, without the document lengths and with the trailing space that
+        # older versions of the query program strip along with the newline
+        writeLines(docIndexFile, (f"{doc}\t{docIndex[doc]['text']} \n" for doc in sorted(docIndex)))
+    else:
+        # write the document index to the file, storing each document's length so it doesn't need to be recomputed at query time
+        writeLines(docIndexFile, (f"{doc}\t{docIndex[doc]['length']}\t{docIndex[doc]['text']}\n" for doc in sorted(docIndex)))
     docIndexFile.close()
 
-    # write the index to the file
-    for token in indexes[0]:
-        indexFile.write("{}\t{}\t{}\n".format(token, str(indexes[0][token]["DF"]), str(indexes[0][token]["postings"])))
+    # write the index to the file in the legacy format, sorting each postings list as it is written
+    if legacyTsv:
+        writeLines(indexFile, (f"{token}\t{index[token]['DF']}\t{sorted(index[token]['postings'])}\n" for token in tokens))
+        indexFile.close()
+        print("Index file generation complete.")
+        return
+
+    # write each term and its DF to the index file
+    writeLines(indexFile, (f"{token}\t{index[token]['DF']}\n" for token in tokens))
     indexFile.close()
+
+    # append each term's sorted postings list to the packed postings array
+    postingsArray = array("I")
+    for token in tokens:
+        postingsArray.extend(sorted(index[token]["postings"]))
+
+    # write the packed postings to the postings file in little-endian byte order
+    if sys.byteorder == "big":
+        postingsArray.byteswap()
+    postingsArray.tofile(postingsFile)
+    postingsFile.close()
         
     print("Index file generation complete.")
 
 
-def buildIndex(corpusPath, indexPath):
+def buildIndex(corpusPath, indexPath, legacyTsv=False):
     """
     This function gets the corpus file and passes it to the index generator before writing the completed index to the index file
     
     Parameters:
         corpusPath (str): the path to the corpus file as specified by the user
         indexPath (str): the path to the folder where the index folder will be created, as specified by the user
+        legacyTsv (bool): whether to write the index files in the legacy format read by older versions of the query program
     """
 
     # open the corpus and index files
@@ -136,12 +414,12 @@ def buildIndex(corpusPath, indexPath):
     except FileNotFoundError:
         print("Error: could not find the corpus file")
         return
-    # generate a list of JSON objects from the corpus file
-    corpus = json.load(corpusFile)
+    # generate the index dictionaries from the JSON objects in the corpus file, reading one document at a time
+    indexes = generateIndex(iterCorpus(corpusFile))
     corpusFile.close()
 
     # generate the index folder and files
-    generateIndexFiles(indexPath, generateIndex(corpus))
+    generateIndexFiles(indexPath, indexes, legacyTsv)
 
 
 def main(args):
@@ -149,13 +427,18 @@ def main(args):
     The main function of the program
 
     Parameters:
-        args (list): both the location of the corpus file and the location of where the index folder will be created
+        args (list): both the location of the corpus file and the location of where the index folder will be created, and
+            optionally the --legacy-tsv flag
     """
     # check if the user wants to see the help message
     if "-h" in args or "--help" in args or len(args) == 0:
-        print("Usage: python main.py [path to corpus] [path to index folder]")
+        print("Usage: python main.py [path to corpus] [path to index folder] [--legacy-tsv]")
         return
 
+    # check if the user wants the postings lists written into the index file as in older versions of the index
+    legacyTsv = "--legacy-tsv" in args
+    args = [arg for arg in args if arg != "--legacy-tsv"]
+
     # check if the user provided both the corpus and the index folder
     if len(args) != 2:
         print("Error: please provide both the corpus and the index folder")
@@ -164,7 +447,7 @@ def main(args):
     # get the corpus and the index folder
     corpusPath = args[0]
     indexPath = args[1]
-    buildIndex(corpusPath, indexPath)
+    buildIndex(corpusPath, indexPath, legacyTsv)
 
 
 if __name__ == "__main__":
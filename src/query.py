@@ -1,16 +1,118 @@
 import sys
+import bisect
+import heapq
+import math
+import mmap
+import re
+from array import array
 
+# matches either a search phrase enclosed by a pair of phrase delimiters (group 1) or a single search keyword (group 2)
+QUERY_RE = re.compile(r':([^:]+):|(\S+)')
+# a postings list containing at least this fraction of all docs is dense, so a set of its docIDs may be built for fast membership
+# checks once it is intersected with enough docs that building the set is cheaper than galloping through the postings list
+DENSE_FRACTION = 1/16
 
-def cosineScore(index, docIndex, keywords, docs, numResults):
+
+def intersectSorted(a, b):
+    """
+    Intersects two sorted postings lists. If one list is much shorter than the other, each docID in the shorter list is found in
+    the longer list with a binary search that only moves forward (galloping), otherwise both lists are merged in a single pass.
+
+    Parameters:
+        a (list): a sorted list of docIDs
+        b (list): a sorted list of docIDs
+
+    Returns:
+        intersection (list): the sorted list of docIDs found in both lists
+    """
+
+    # make sure a is the shorter of the two lists
+    if len(a) > len(b):
+        a, b = b, a
+    intersection = []
+    if len(a) == 0:
+        return intersection
+
+    # if searching the longer list for each docID is cheaper than walking both lists, gallop through the longer list
+    if len(a) * math.log2(len(b)) < len(a) + len(b):
+        j = 0
+        for docId in a:
+            j = bisect.bisect_left(b, docId, j)
+            if j == len(b):
+                break
+            if b[j] == docId:
+                intersection.append(docId)
+        return intersection
+
+    # otherwise, merge the two lists by advancing whichever list has the smaller docID
+    i = 0
+    j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            intersection.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return intersection
+
+
+def getPostings(index, row):
+    """
+    Gets the postings list of a term in the inverted index as a slice of the postings buffer. Slices of the postings file don't copy
+    any docIDs, while slices of a legacy index's list of docIDs do.
+
+    Parameters:
+        index (dict): the inverted index
+        row (int): the term's row in the inverted index
+
+    Returns:
+        postings (memoryview or list): the term's sorted postings list
+    """
+
+    return index["postings"][index["offsets"][row]:index["offsets"][row + 1]]
+
+
+def intersectPostings(docs, index, row):
+    """
+    Intersects a sorted list of docIDs with the postings list of a term in the inverted index. If the term's postings list is dense
+    and its set of docIDs is already built or worth building (i.e. the docs are too many to gallop through the postings list), the docs
+    are filtered by membership in the term's set of docIDs instead of walking its postings list.
+
+    Parameters:
+        docs (list): a sorted list of docIDs
+        index (dict): the inverted index
+        row (int): the term's row in the inverted index
+
+    Returns:
+        intersection (list): the sorted list of docIDs found in both the list of docs and the term's postings list
+    """
+
+    if len(docs) == 0:
+        return []
+
+    DF = index["DF"][row]
+    if row not in index["postingsSets"] and DF >= index["denseDF"] and len(docs) * math.log2(DF) > DF:
+        # build the dense postings list's set of docIDs the first time it is cheaper than galloping through the postings list
+        index["postingsSets"][row] = frozenset(getPostings(index, row))
+    if row in index["postingsSets"]:
+        postingsSet = index["postingsSets"][row]
+        return [doc for doc in docs if doc in postingsSet]
+    return intersectSorted(docs, getPostings(index, row))
+
+
+def cosineScore(index, docLengths, keywords, docs, numResults):
     """
     Calculates the fast-cosine score of each document in the list of documents that contain at least one of the search phrases.
     Uses the algorithm described in Figure 7.1 of the textbook.
 
     Parameters:
         index (dict): the inverted index
-        docIndex (dict): the document index
+        docLengths (dict): the number of terms in each document
         keywords (list): the list of search keywords
-        docs (list): the list of docIDs that contain at least one of the search phrases
+        docs (list): the sorted list of docIDs that contain at least one of the search phrases
         numResults (int): the number of results to return
     
     Returns:
@@ -18,39 +120,40 @@ def cosineScore(index, docIndex, keywords, docs, numResults):
         docCount (int): the number of documents with non-zero cosine scores
     """
     
-    scores = {}
-    lengths = {}
+    # if there are no keywords, no document can have a non-zero score
+    if len(keywords) == 0:
+        return [{}, 0]
 
-    for doc in docs:
-        scores[doc] = 0
-        # set the length of the document to the number of terms in the document
-        lengths[doc] = float(len(docIndex[doc].split()))
+    # start every possible matching doc with a score of 0
+    scores = dict.fromkeys(docs, 0)
 
+    # every keyword is weighted equally, so the weight only needs to be calculated once
+    termWeight = 1/len(keywords)
     for term in keywords:
-        termWeight = 1/len(keywords)
         try:
-            # get the postings list for the current term
-            postings = index[term]["postings"]
+            # get the row of the current term in the inverted index
+            row = index["terms"][term]
         except KeyError:
             # if the term does not exist in the index, skip it
             continue
-        # get the intersection of the postings list for the current term and the list of possible matching docs
-        intersect = list(set(postings) & set(docs))
+        postings = getPostings(index, row)
+        # get the docs in both the postings list for the current term and the (sorted) list of possible matching docs; if the
+        # postings list already has a set of its docIDs or is much longer than the list of possible matching docs, filter or gallop
+        # through it, otherwise scan it once, checking each docID against the scores (which have a key for every possible matching doc)
+        if row in index["postingsSets"] or len(docs) * len(docs) < len(postings):
+            intersect = intersectPostings(docs, index, row)
+        else:
+            intersect = [doc for doc in postings if doc in scores]
         for doc in intersect:
-            try:
-                scores[doc] += termWeight
-            except KeyError:
-                scores[doc] = termWeight
-
-    cosineScores = {}
-    for doc in lengths.keys():
-        # calculate the cosine score for each document
-        cosineScores[doc] = scores[doc]/lengths[doc]
-    # sort the scores in descending order
-    cosineScores = {k: v for k, v in sorted(cosineScores.items(), key=lambda item: item[1], reverse=True) if v > 0}
+            scores[doc] += termWeight
+
+    # calculate the cosine score for each document with a non-zero score, dividing by the number of terms in the document
+    cosineScores = {doc: score/docLengths[doc] for doc, score in scores.items() if score > 0}
+    # select the top numResults scores in descending order without sorting every score (ties keep their docID order)
+    topScores = heapq.nlargest(numResults, cosineScores.items(), key=lambda item: item[1])
 
     # return the top numResults results and the number of documents with non-zero scores
-    return [dict(list(cosineScores.items())[0:numResults]), len(cosineScores)]
+    return [dict(topScores), len(cosineScores)]
 
 
 def getPhraseResults(index, docIndex, phrases):
@@ -66,54 +169,65 @@ def getPhraseResults(index, docIndex, phrases):
         phraseResults (list): the list of docIDs that contain at least one of the search phrases
         consideredDocs (int): the number of documents considered when searching for the search phrases
     """
-    phraseResults = []
-    consideredDocs = []
+    phraseResults = set()
+    consideredDocs = set()
 
     # if the list of phrases is empty, return a list of all docIDs
     if len(phrases) == 0:
         return [sorted(list(docIndex.keys())), len(docIndex.keys())]
 
+    # sort the docIDs once so every phrase can start from the same sorted list of possible matching docs
+    allDocs = sorted(docIndex.keys())
     for phrase in phrases:
-        docs = docIndex.keys()
+        docs = allDocs
+        phrase = phrase.strip()
         # split the phrase into individual terms
         terms = phrase.split()
-        # get the postings list for the first term in the phrase
-        for term in terms:
-            try:
-                postings = index[term]["postings"]
-            except KeyError:
-                # if the term does not exist in the index discard the phrase
-                break    
+        # if any term does not exist in the index, no doc can contain the phrase, so discard it before intersecting anything
+        if any(term not in index["terms"] for term in terms):
+            continue
+        # intersect the terms with the shortest postings lists first so the list of possible matching docs stays as small as possible
+        rows = sorted((index["terms"][term] for term in terms), key=lambda row: index["DF"][row])
+        for row in rows:
             # intersect the postings list with the list of possible matching docs
-            docs = list(set(docs) & set(postings))
+            docs = intersectPostings(docs, index, row)
 
         for doc in docs:
             # iterate through each doc and check if it contains the entire phrase
-            if phrase.strip() in docIndex[doc] and doc not in phraseResults:
-                # if the doc contains the entire phrase, add it to the list of phrase results
-                phraseResults.append(doc)
-            if doc not in consideredDocs:
-                # if the doc hasn't been considered yet, add it to the list of considered docs
-                consideredDocs.append(doc)
-        
+            if phrase in docIndex[doc]:
+                # if the doc contains the entire phrase, add it to the set of phrase results
+                phraseResults.add(doc)
+            # add the doc to the set of considered docs
+            consideredDocs.add(doc)
+
     return [sorted(phraseResults), len(consideredDocs)]
 
 
 def buildIndexes(indexPath):
     """
-    Takes the path to the index folder and builds the inverted index and the document index using the .tsv files in the index folder
+    Takes the path to the index folder and builds the inverted index and the document index using the .tsv files in the index folder.
+    If the index folder has a binary postings file, only the terms and their DFs are read, and the postings file is memory-mapped so
+    the postings lists are only read from disk when they are used. Otherwise, the postings lists are parsed from the index file as
+    written by older versions of the indexer.
+    The inverted index is stored as a struct of arrays: a dictionary mapping each term to its row, an array of each row's DF, and one
+    buffer holding every postings list back to back, with an array of the offset at which each row's postings list starts.
 
     Parameters:
         indexPath (str): the path to the index folder
 
     Returns:
-        index (dict): the inverted index
+        index (dict): the inverted index, containing the "terms", "DF", "offsets", "postings", and the "denseDF" at which "postingsSets"
+            are built for dense postings lists
         docIndex (dict): the document index
+        docLengths (dict): the number of terms in each document
     """
 
-    # create the index and document index dictionaries
-    index = {}
+    # create the inverted index arrays and the document index and document length dictionaries
+    terms = {}
+    DFs = array("I")
+    offsets = array("Q", [0])
     docIndex = {}
+    docLengths = {}
 
     # open the index and document index files
     try:
@@ -127,24 +241,68 @@ def buildIndexes(indexPath):
         print("Document index file not found. Please run the indexer before running the query engine or make sure the path to the index folder is correct.")
         sys.exit()
 
+    try:
+        postingsFile = open("{}\\postings.bin".format(indexPath), "rb")
+    except FileNotFoundError:
+        postingsFile = None
+
+    if postingsFile == None:
+        # legacy index files can contain docIDs of any size, so their postings are parsed into a list of Python integers
+        postings = []
+    elif sys.byteorder == "big":
+        # the packed postings are little-endian, so big-endian machines read them all at once and swap their byte order
+        postingsArray = array("I")
+        postingsArray.frombytes(postingsFile.read())
+        postingsArray.byteswap()
+        postingsFile.close()
+        postings = memoryview(postingsArray)
+    else:
+        # map the postings file into memory instead of reading it, so only the parts holding the postings lists of queried terms
+        # are ever read from disk
+        try:
+            postings = memoryview(mmap.mmap(postingsFile.fileno(), 0, access=mmap.ACCESS_READ)).cast("I")
+        except ValueError:
+            # an empty postings file (from an empty corpus) can't be mapped
+            postings = memoryview(array("I"))
+        postingsFile.close()
+
     # read the index file line by line
     for line in indexFile:
-        [token, DF, postings] = line.split("\t")
-        # remove the brackets and delimiters from the postings list
-        postings = postings[1:len(postings) - 2].split(", ")
-        # iterate through each posting, convert it to an integer, and create a token entry in the index
-        postingsInt = []
-        for docId in postings:
-            postingsInt.append(int(docId))
-        index[token] = {"DF": int(DF), "postings": postingsInt}
+        (token, _, columns) = line.partition("\t")
+        (DF, _, legacyPostings) = columns.partition("\t")
+        # give the token the next row in the index, interning it so lookups with an equal interned keyword compare by identity
+        terms[sys.intern(token)] = len(DFs)
+        DFs.append(int(DF))
+        if postingsFile == None:
+            # remove the brackets and delimiters from the legacy postings list, convert every posting to an integer in a single map
+            # call, and append the postings to the list of postings
+            postings.extend(map(int, legacyPostings[1:len(legacyPostings) - 2].split(", ")))
+            offsets.append(len(postings))
+        else:
+            # take the next DF postings from the postings file as the token's postings list
+            offsets.append(offsets[len(offsets) - 1] + DFs[len(DFs) - 1])
+
+    index = {"terms": terms, "DF": DFs, "offsets": offsets, "postings": postings, "postingsSets": {}}
 
     # read the document index file line by line
     for line in docIndexFile:
-        [docId, docString] = line.split("\t")
-        # remove the newline character from the document string and add the document ID and document string to the document index
-        docIndex[int(docId)] = docString[:len(docString) - 2]
+        columns = line.split("\t")
+        # remove the trailing newline (and any trailing space left by older index files) from the document string and add the
+        # document ID and document string to the document index
+        docId = int(columns[0])
+        docString = columns[len(columns) - 1].rstrip()
+        docIndex[docId] = docString
+        if len(columns) == 3:
+            docLengths[docId] = int(columns[1])
+        else:
+            # older document index files don't store the document length, so count the terms once while loading
+            docLengths[docId] = len(docString.split())
+
+    # dense postings lists get a set of their docIDs when they are first used, so intersecting them costs one membership check per
+    # candidate doc
+    index["denseDF"] = DENSE_FRACTION * len(docIndex)
 
-    return [index, docIndex]
+    return [index, docIndex, docLengths]
 
 
 def parseQuery(query):
@@ -159,46 +317,24 @@ def parseQuery(query):
         phrases (list): the list of all the search phrases
     """
 
+    # a term that is just a phrase delimiter means the delimiter is separated from the first/last term in the phrase by a space
+    if ":" in query:
+        print("Invalid use of phrase delimiter. Make sure there is no space between the phrase delimiter and the first/last term in the phrase.")
+        sys.exit()
+
     keywords = []
     phrases = []
-    phrase = ""
-    isPhrase = False
-
-    # iterate through each query term
-    for term in query:
-        # if the current term is a phrase delimiter, toggle the phrase flag
-        if term[0] == ':':
-            isPhrase = not isPhrase
-            if not isPhrase:
-                # if the current term is the end-phrase delimiter, add the phrase to the list of phrases
-                phrases.append(phrase.strip())
-                phrase = ""
-            if len(term) == 1:
-                # if the current term is just a phrase delimiter, continue to the next term
-                print("Invalid use of phrase delimiter. Make sure there is no space between the phrase delimiter and the first/last term in the phrase.")
-                sys.exit()
-        if isPhrase:
-            # if the phrase flag is true, add the term to the current phrase
-            if term[0] == ":":
-                # if the current term contains the start-phrase delimiter, check if it is the only term in the phrase
-                if term[len(term) - 1] == ":":
-                    # if the current term is the only term in the phrase, add it to the list of phrases; otherwise, append it to the current phrase
-                    phrase = term[1:len(term) - 1]
-                    phrases.append(phrase.strip())
-                    phrase = ""
-                else: phrase += term[1:] + " "
-            elif term[len(term) - 1] == ":":
-                # if the current term contains the end-phrase delimiter, append it to the current phrase and add the phrase to the list of phrases
-                phrase += term[:len(term) - 1] + " "
-                phrases.append(phrase.strip())
-                phrase = ""
-                isPhrase = False
-            else:
-                # if the current term is in the middle of the phrase, append it to the current phrase
-                phrase += term + " "
+    # scan the whole query once, matching either a phrase enclosed by a pair of delimiters or a single keyword
+    for [phrase, keyword] in QUERY_RE.findall(" ".join(query)):
+        if phrase != "":
+            phrases.append(phrase.strip())
         else:
-            # if the phrase flag is false, add the term to the list of keywords
-            keywords.append(term)
+            keywords.append(keyword)
+
+    # if the query only contained whitespace, there is nothing to search for
+    if len(keywords) == 0 and len(phrases) == 0:
+        print("Error: please provide at least one search keyword or phrase")
+        sys.exit()
 
     # return the lists of keywords and phrases
     return [keywords, phrases]
@@ -236,16 +372,18 @@ def main(args):
     query = args[2:]
     # generate the lists of keywords and phrases as well as the inverted index and document index
     [keywords, phrases] = parseQuery(query)
-    [index, docIndex] = buildIndexes(indexPath)
+    [index, docIndex, docLengths] = buildIndexes(indexPath)
 
-    # append all the phrase terms to the list of keywords
+    # append all the phrase terms to the list of keywords, and intern the keywords so looking them up in the index compares the
+    # interned index terms by identity
     for phrase in phrases:
         keywords += phrase.split()
+    keywords = [sys.intern(keyword) for keyword in keywords]
     
     # Get a list of documents that contain any of the search phrases
     [docs, numDocsConsidered] = getPhraseResults(index, docIndex, phrases)
     # calculate the fast-cosine score of each document
-    [scores, nonZeroScoreDocs] = cosineScore(index, docIndex, keywords, docs, numResults)
+    [scores, nonZeroScoreDocs] = cosineScore(index, docLengths, keywords, docs, numResults)
     
     # print the results as per the assignment specifications
     print("Number of documents considered: " + str(numDocsConsidered))